@@ -30,7 +30,7 @@
 # All variables are in SI units by default. Exceptions explicit by variable name.
 # -----------------------------------------------------------------------------------------------------
 from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
-import numpy, os
+import numpy, os, hashlib, types
   
 import logging
 logger = logging.getLogger(__name__)
@@ -42,95 +42,517 @@ try:
 except ImportError:
     log_warning(logger, "Could not import h5py.")
 
+try:
+    # Registers the LZ4, Blosc and Bitshuffle filters with HDF5
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+# Minimum size of an HDF5 chunk in bytes when chunks are chosen per frame
+_MIN_CHUNK_BYTES = 10*1024
+# Maximum size of an HDF5 chunk in bytes, chunks must fit into a page of the file space (HDF5 rejects chunks of 4 GiB and more)
+_MAX_CHUNK_BYTES = 8*1024*1024
+
+# Bounds of the page size of the file space in bytes
+_MIN_PAGE_BYTES = 1024*1024
+_MAX_PAGE_BYTES = 16*1024*1024
+
+# Keyword arguments passed to h5py for the supported compression filters
+_COMPRESSION_KWARGS = {
+    "gzip": {"compression": "gzip"},
+    # Filters provided by hdf5plugin (filter IDs registered with The HDF Group)
+    "lz4": {"compression": 32004},
+    "blosc": {"compression": 32001, "compression_opts": (0, 0, 0, 0, 5, 1, 1)}, # LZ4 with byte shuffle
+    "bitshuffle": {"compression": 32008, "compression_opts": (0, 2)}, # LZ4 after bit shuffle
+}
+
+def _get_group_prefix(keys):
+    return "/" + "".join([k + "/" for k in keys])
+
+def _get_chunk_nbytes(chunks, dtype):
+    if chunks is True:
+        # Chunks chosen by h5py are at most 1 MiB
+        return 1024*1024
+    return int(numpy.prod(chunks)) * numpy.dtype(dtype).itemsize
+
+def _resolve_dtype_and_shape(data):
+    # Returns shape, data type and CXI axes attribute of a stack entry
+    if isinstance(data, (str, bytes)):
+        return (), h5py.string_dtype(encoding="utf-8"), "experiment_identifier:value"
+    if isinstance(data, (bool, int, float, complex)):
+        return (), numpy.dtype(type(data)), "experiment_identifier:value"
+    data = numpy.asarray(data)
+    # Raises TypeError if the data type is not supported by HDF5
+    h5py.h5t.py_create(data.dtype, logical=1)
+    axes = "experiment_identifier"
+    if data.ndim == 0: axes = axes + ":value"
+    elif data.ndim == 1: axes = axes + ":x"
+    elif data.ndim == 2: axes = axes + ":y:x"
+    elif data.ndim == 3: axes = axes + ":z:y:x"
+    # Stack in native byte order so that writing the buffer requires no conversion
+    return data.shape, data.dtype.newbyteorder("="), axes
+
+def _get_layout(D, keys=()):
+    # Returns (key path, lookup, set of keys) for D and all its nested dictionaries
+    layout = [(keys, _make_getter(keys), frozenset(D.keys()))]
+    for k in D.keys():
+        if isinstance(D[k], dict):
+            layout += _get_layout(D[k], keys + (k,))
+    return layout
+
+def _make_getter(keys):
+    # Returns a function that looks up the value at the given key path of a nested dictionary
+    def getter(D):
+        for k in keys:
+            D = D[k]
+        return D
+    return getter
+
+def _compile_write(schema, layout):
+    # Generates a write method with one direct buffer assignment per dataset, dictionaries with a different layout are passed on to the generic write method
+    namespace = {}
+    lines = ["def write(self, D):",
+             "    j = self._buffered",
+             "    try:"]
+    for i, (keys, getter, key_set) in enumerate(layout):
+        namespace["k%i" % i] = key_set
+        lines.append("        if D%s.keys() != k%i:" % ("".join(["[%r]" % k for k in keys]), i))
+        lines.append("            return type(self).write(self, D)")
+    for g, (group_keys, getter, leaves) in enumerate(schema):
+        lines.append("        g%i = D%s" % (g, "".join(["[%r]" % k for k in group_keys])))
+        for l, (k, buf, fill) in enumerate(leaves):
+            namespace["b%i_%i" % (g, l)] = buf
+            lines.append("        b%i_%i[j] = g%i[%r]" % (g, l, g, k))
+    lines += ["    except (KeyError, TypeError, ValueError):",
+              "        return type(self).write(self, D)",
+              "    self._i += 1",
+              "    self._buffered += 1",
+              "    if self._buffered == self._chunksize:",
+              "        self._write_buffer()",
+              "        self._f.flush()"]
+    exec("\n".join(lines), namespace)
+    return namespace["write"]
+
 class CXIWriter:
-    def __init__(self, filename, chunksize=2, gzip_compression=False):
+    """
+    Class for writing dictionaries of data to a CXI file (HDF5)
+
+    Every call of :meth:`write` appends one entry to the stack of each dataset. Nested dictionaries are written as groups. The datasets are created from the first written dictionary. As long as the following dictionaries have the same keys their values are copied along a precomputed schema, new keys are added as datasets when they appear.
+
+    **Arguments:**
+
+      :filename (str): Name of the output file. An existing file is overwritten
+
+    **Keyword arguments:**
+
+      :chunksize (int): Number of stack entries that are buffered in memory before they are written to file (default ``2``)
+
+      :compression (str): Compression filter applied to array datasets (scalar datasets are not compressed). Choose among ``'gzip'``, ``'lz4'``, ``'blosc'`` and ``'bitshuffle'``. All filters except ``'gzip'`` require the package ``hdf5plugin`` (default ``None``)
+
+      :gzip_compression (bool): Same as ``compression='gzip'``, kept for backwards compatibility (default ``False``)
+
+      :chunks (str): HDF5 chunking of the datasets. If ``chunks='per_frame'`` every stack entry of at least 10 KiB (e.g. a detector frame) is stored in a chunk of its own while smaller entries are grouped into chunks of at least 10 KiB. Entries larger than 8 MiB are split into several chunks along their leading axes. If ``chunks='auto'`` the chunk shapes are chosen by h5py (default ``'per_frame'``)
+
+      :expected_n (int): Expected number of stack entries. If given, datasets are allocated for ``expected_n`` entries at creation. Otherwise the stacks grow by doubling their length. Excess entries are removed when the file is closed (default ``None``)
+
+      :dedup (bool): If ``True`` identical array entries of at least 10 KiB (e.g. blank detector frames) are stored only once. For such a dataset ``NAME`` the unique entries are stored in ``NAME_unique`` and the stack position of every entry in ``NAME_index``. On :meth:`close` ``NAME`` is created as a virtual dataset that maps every stack position to its unique entry. Cannot be combined with ``mpi=True`` (default ``False``)
+
+      :mpi (bool): If ``True`` all processes of ``MPI.COMM_WORLD`` write to the same file with collective I/O. Every process must create the writer, call :meth:`write` equally often with dictionaries of the same layout and call :meth:`close`. Each batch of entries of a process is written to a contiguous range of stack positions. Requires ``mpi4py`` and h5py built with MPI support, compression is not applied (default ``False``)
+    """
+    def __init__(self, filename, chunksize=2, gzip_compression=False, expected_n=None, chunks="per_frame", compression=None, dedup=False, mpi=False):
         self._filename = os.path.expandvars(filename)
-        if os.path.exists(filename):
-            log_warning(logger, "File %s exists and is being overwritten" % filename)
-        self._f = h5py.File(filename, "w")
         self._i = 0
+        # Number of stack entries written to file (by all processes in MPI mode)
+        self._n_written = 0
         self._chunksize = chunksize
+        self._expected_n = expected_n
+        if chunks not in ["per_frame", "auto"]:
+            log_and_raise_error(logger, "Invalid argument chunks=%s. Choose either 'per_frame' or 'auto'." % str(chunks))
+        self._chunks = chunks
+        if gzip_compression and compression is None:
+            compression = "gzip"
         self._create_dataset_kwargs = {}
-        if gzip_compression:
-            self._create_dataset_kwargs["compression"] = "gzip"
+        if compression is not None:
+            if compression not in _COMPRESSION_KWARGS:
+                log_and_raise_error(logger, "Invalid argument compression=%s. Choose among %s." % (str(compression), ", ".join(sorted(_COMPRESSION_KWARGS.keys()))))
+            if compression != "gzip" and hdf5plugin is None:
+                log_and_raise_error(logger, "Compression \"%s\" requires the package hdf5plugin, which could not be imported." % compression)
+            self._create_dataset_kwargs.update(_COMPRESSION_KWARGS[compression])
+        self._dedup = dedup
+        if dedup and mpi:
+            log_and_raise_error(logger, "Deduplication of entries is not supported in MPI mode.")
+        self._comm = None
+        if mpi:
+            try:
+                from mpi4py import MPI
+            except ImportError:
+                log_and_raise_error(logger, "MPI mode requires the package mpi4py, which could not be imported.")
+            if not h5py.get_config().mpi:
+                log_and_raise_error(logger, "MPI mode requires h5py built with MPI support.")
+            if self._create_dataset_kwargs:
+                log_warning(logger, "Compression is not supported in MPI mode and will not be applied.")
+                self._create_dataset_kwargs = {}
+            self._comm = MPI.COMM_WORLD
+        if os.path.exists(self._filename):
+            log_warning(logger, "File %s exists and is being overwritten" % self._filename)
+        # The file is opened with HDF5 on the first write when the sizes of the chunks are known. It is created here already so that a path that cannot be written to fails before any data is computed
+        try:
+            open(self._filename, "wb").close()
+        except (IOError, OSError) as e:
+            log_and_raise_error(logger, "Cannot create file %s (%s)." % (self._filename, str(e)))
+        self._f = None
+        # Stack entries are collected in memory and written to file in batches of chunksize
+        self._buffer = {}
+        self._buffered = 0
+        # Handles and stack shapes of all groups and datasets created so far
+        self._groups = {}
+        self._datasets = {}
+        self._shapes = {}
+        # Deduplicated datasets: name -> (keys, buffer, dataset of unique entries, buffer of unique entry indices, hashes of unique entries)
+        self._deduplicated = {}
+        # Names of the stacks of unique entries and of their indices that belong to deduplicated datasets
+        self._reserved = set()
+        # List of (key path of a dictionary, lookup of the dictionary, [(key, buffer, fill value), ...]) for all dictionaries that contain datasets
+        self._schema = None
+        self._leaves = None
+        # List of (key path, lookup, set of keys) for all dictionaries of the last written dictionary
+        self._layout = None
+        # Names of values that could not be converted to a dataset
+        self._skipped = set()
+        # Whether write is replaced by a method generated for the layout (see from_template)
+        self._compiled = False
+
+    @classmethod
+    def from_template(cls, filename, template, n_expected, **kwargs):
+        """
+        Create a writer that is specialized to dictionaries with the layout of a template
+
+        The datasets are created from ``template`` (which is not written) and allocated for ``n_expected`` entries. :meth:`write` is replaced by a function that is generated for this layout and copies every value to its buffer directly. Values are not checked for their data type or shape. Dictionaries with a different layout or values that cannot be copied are handled like in :meth:`write`.
+
+        Args:
+          :filename (str): Name of the output file
+
+          :template (dict): Dictionary with the same keys, shapes and data types as the dictionaries that will be written
+
+          :n_expected (int): Expected number of stack entries
+
+        Kwargs:
+          All keyword arguments of :class:`condor.utils.cxiwriter.CXIWriter` except ``expected_n``
+        """
+        W = cls(filename, expected_n=n_expected, **kwargs)
+        W._create_schema(template)
+        W._compile()
+        return W
 
     def write(self, D):
-        self._write_without_iterate(D)
-        self._f.flush()
+        """
+        Append the data of a dictionary to the stacks
+
+        Entries are buffered in memory and written to file in batches of ``chunksize``. The file is flushed after every batch. Call :meth:`sync` to make all entries written so far durable.
+
+        Keys that were not present in earlier dictionaries are added as new datasets (with fill values at all earlier stack positions). Datasets whose key is missing in a dictionary are filled with their fill value (``0`` or an empty string) at this stack position.
+
+        Args:
+          :D (dict): Dictionary of scalars and arrays, nested dictionaries are written as groups
+        """
+        if self._schema is None:
+            self._create_schema(D)
+        # View on the buffer row of every dataset, data is copied in place without allocating new arrays
+        j = slice(self._buffered, self._buffered+1)
+        if not self._layout_matches(D) or not self._copy_entries(D, j):
+            # The keys differ from the last written dictionary
+            self._update_schema(D)
+            self._copy_entries(D, j, fill_missing=True)
         self._i += 1
-        
-    def _write_without_iterate(self, D, group_prefix="/"):
+        self._buffered += 1
+        if self._buffered == self._chunksize:
+            self._write_buffer()
+            self._f.flush()
+
+    def _compile(self):
+        self._compiled = True
+        self.write = types.MethodType(_compile_write(self._schema, self._layout), self)
+
+    def _layout_matches(self, D):
+        # Cheap check whether all dictionaries of the last written dictionary exist in D with the same keys (including keys that were skipped)
+        for keys, getter, key_set in self._layout:
+            try:
+                group = getter(D)
+            except (KeyError, TypeError):
+                return False
+            if not isinstance(group, dict) or group.keys() != key_set:
+                return False
+        return True
+
+    def _copy_entries(self, D, j, fill_missing=False):
+        # Returns False if a key of the schema is missing in D unless missing entries are filled
+        for group_keys, getter, leaves in self._schema:
+            try:
+                group = getter(D)
+            except (KeyError, TypeError):
+                group = None
+            if not isinstance(group, dict):
+                if not fill_missing:
+                    return False
+                group = {}
+            for k, buf, fill in leaves:
+                if k in group:
+                    if isinstance(fill, str):
+                        # String datasets are buffered as objects, which numpy.copyto accepts of any type
+                        if not isinstance(group[k], (str, bytes)):
+                            log_and_raise_error(logger, "Cannot write value of %s to %s. The dataset stores strings but the value is of type %s." % (_get_group_prefix(group_keys) + k, self._filename, type(group[k]).__name__))
+                        buf[j] = group[k]
+                        continue
+                    try:
+                        shape = numpy.shape(group[k])
+                    except ValueError:
+                        # Nested sequences of different lengths
+                        shape = None
+                    if shape != buf.shape[1:]:
+                        # numpy.copyto would broadcast values of a smaller shape to the whole entry
+                        log_and_raise_error(logger, "Cannot write value of %s to %s. Its shape %s does not match the shape of the dataset entries %s." % (_get_group_prefix(group_keys) + k, self._filename, str(shape), str(buf.shape[1:])))
+                    try:
+                        numpy.copyto(buf[j], group[k], casting="same_kind")
+                    except (TypeError, ValueError) as e:
+                        log_and_raise_error(logger, "Cannot write value of %s to %s. Its data type does not match the data type of the dataset (%s)." % (_get_group_prefix(group_keys) + k, self._filename, str(e)))
+                elif fill_missing:
+                    buf[j] = fill
+                else:
+                    return False
+        return True
+
+    def _create_schema(self, D):
+        groups = []
+        entries = []
+        self._collect_schema(D, (), groups, entries)
+        # Pages of the file space must be larger than the largest chunk
+        chunk_nbytes = [_get_chunk_nbytes(self._get_chunks(data_shape, dtype), dtype) for keys, data_shape, dtype, axes in entries]
+        self._open(max([0] + chunk_nbytes))
+        self._leaves = {}
+        self._add_to_schema(groups, entries)
+        self._layout = _get_layout(D)
+
+    def _update_schema(self, D):
+        if self._comm is not None:
+            log_and_raise_error(logger, "Cannot write dictionary to %s. In MPI mode all dictionaries must have the same keys." % self._filename)
+        groups = []
+        entries = []
+        self._collect_schema(D, (), groups, entries)
+        self._add_to_schema(groups, entries)
+        self._layout = _get_layout(D)
+        if self._compiled and entries:
+            # The generated write method has to include the new datasets, dictionaries that only differ in their layout take the generic copy
+            self._compile()
+
+    def _add_to_schema(self, groups, entries):
+        # Datasets that appear after entries have been written to file are not deduplicated, their earlier stack positions would reference unique entries of other frames
+        entries = [(keys, data_shape, dtype, axes, self._dedup and self._n_written == 0 and _get_chunk_nbytes(data_shape, dtype) >= _MIN_CHUNK_BYTES) for keys, data_shape, dtype, axes in entries]
+        names = set([_get_group_prefix(keys) for keys in groups] + [_get_group_prefix(keys[:-1]) + keys[-1] for keys, data_shape, dtype, axes, dedup in entries])
+        for keys, data_shape, dtype, axes, dedup in entries:
+            if dedup:
+                name = _get_group_prefix(keys[:-1]) + keys[-1]
+                for reserved in [name + "_unique", name + "_index"]:
+                    if reserved in names or reserved + "/" in names or reserved in self._shapes or reserved + "/" in self._groups:
+                        log_and_raise_error(logger, "Cannot write dictionary to %s. The name %s is reserved for the deduplicated dataset %s." % (self._filename, reserved, name))
+                    self._reserved.add(reserved)
+        for keys in groups:
+            group_prefix = _get_group_prefix(keys)
+            log_debug(logger, "Create group %s" % group_prefix)
+            self._groups[group_prefix] = self._groups[_get_group_prefix(keys[:-1])].create_group(keys[-1])
+        for keys, data_shape, dtype, axes, dedup in entries:
+            name = _get_group_prefix(keys[:-1]) + keys[-1]
+            n = self._expected_n if self._expected_n is not None else self._chunksize
+            shape = (n,) + data_shape
+            # Chunk dimensions of entries of zero length exceed the entry shape, HDF5 only allows this for unlimited dimensions
+            maxshape = (None,) + tuple([d if d > 0 else None for d in data_shape])
+            chunks = self._get_chunks(data_shape, dtype)
+            log_debug(logger, "Create dataset %s [shape=%s, dtype=%s, chunks=%s]" % (name,str(shape),str(dtype),str(chunks)))
+            # Compression is only applied to array datasets
+            kwargs = self._create_dataset_kwargs if data_shape else {}
+            group = self._groups[_get_group_prefix(keys[:-1])]
+            dset = group.create_dataset(keys[-1] + ("_unique" if dedup else ""), shape, maxshape=maxshape, dtype=dtype, chunks=chunks, **kwargs)
+            dset.attrs.modify("axes",[axes.encode('utf8')])
+            self._shapes[name] = shape
+            # The buffer matches the dataset in data type and is C-contiguous so that it can be copied to file without conversion
+            buf = numpy.zeros((self._chunksize,) + data_shape, dtype=dset.dtype)
+            fill = "" if h5py.check_string_dtype(dset.dtype) is not None else 0
+            buf[...] = fill
+            if dedup:
+                # The stack of unique entries is written and shrunk separately, the stack of their indices like any other dataset
+                index_name = name + "_index"
+                index_dset = group.create_dataset(keys[-1] + "_index", (n,), maxshape=(None,), dtype="int64", chunks=self._get_chunks((), numpy.dtype("int64")))
+                index_dset.attrs.modify("axes",["experiment_identifier:value".encode('utf8')])
+                self._datasets[index_name] = index_dset
+                self._shapes[index_name] = (n,)
+                self._buffer[index_name] = numpy.zeros(self._chunksize, dtype="int64")
+                self._deduplicated[name] = (keys, buf, dset, self._buffer[index_name], {})
+            else:
+                self._datasets[name] = dset
+                self._buffer[name] = buf
+            self._leaves.setdefault(keys[:-1], []).append((keys[-1], buf, fill))
+        self._schema = [(group_keys, _make_getter(group_keys), group_leaves) for group_keys, group_leaves in self._leaves.items()]
+
+    def _collect_schema(self, D, keys, groups, entries):
+        # Collects the groups and datasets of D that do not exist yet
         for k in D.keys():
+            name = _get_group_prefix(keys) + k
+            if name in self._reserved:
+                log_and_raise_error(logger, "Cannot write dictionary to %s. The name %s is reserved for a deduplicated dataset." % (self._filename, name))
             if isinstance(D[k],dict):
-                group_prefix_new = group_prefix + k + "/"
-                log_debug(logger, "Writing group %s" % group_prefix_new)
-                if k not in self._f[group_prefix]:
-                    self._f.create_group(group_prefix_new)
-                self._write_without_iterate(D[k], group_prefix_new)
-            else:
-                name = group_prefix + k
-                log_debug(logger, "Writing dataset %s" % name)
-                data = D[k]
-                if k not in self._f[group_prefix]:
-                    if numpy.isscalar(data):
-                        maxshape = (None,)
-                        shape = (self._chunksize,)
-                        if (isinstance(data, str)):
-                            dtype = numpy.dtype(type(data.encode('utf8')))
-                        else:
-                            dtype = numpy.dtype(type(data))
-                        if dtype == "S":
-                            dtype = h5py.vlen_dtype(str)
-                        axes = "experiment_identifier:value"
-                    else:
-                        data = numpy.asarray(data)
-                        try:
-                            h5py.h5t.py_create(data.dtype, logical=1)
-                        except TypeError:
-                            log_warning(logger, "Could not save dataset %s. Conversion to numpy array failed" % name)
-                            continue
-                        maxshape = tuple([None]+list(data.shape))
-                        shape = tuple([self._chunksize]+list(data.shape))
-                        dtype = data.dtype
-                        ndim = data.ndim
-                        axes = "experiment_identifier"
-                        if ndim == 1: axes = axes + ":x"
-                        elif ndim == 2: axes = axes + ":y:x"
-                        elif ndim == 3: axes = axes + ":z:y:x"
-                    log_debug(logger, "Create dataset %s [shape=%s, dtype=%s]" % (name,str(shape),str(dtype)))
-                    self._f.create_dataset(name, shape, maxshape=maxshape, dtype=dtype, **self._create_dataset_kwargs)
-                    self._f[name].attrs.modify("axes",[axes.encode('utf8')])
-                if self._f[name].shape[0] <= self._i:
-                    if numpy.isscalar(data):
-                        data_shape = []
-                    else:
-                        data_shape = data.shape
-                    new_shape = tuple([self._chunksize*(self._i/self._chunksize+1)]+list(data_shape))
-                    log_debug(logger, "Resize dataset %s [old shape: %s, new shape: %s]" % (name,str(self._f[name].shape),str(new_shape)))
-                    self._f[name].resize(new_shape)
-                log_debug(logger, "Write to dataset %s at stack position %i" % (name, self._i))
-                if numpy.isscalar(data):
-                    self._f[name][self._i] = data
+                if name in self._shapes:
+                    log_and_raise_error(logger, "Cannot write dictionary to %s. The dictionary %s replaces a dataset of the same name." % (self._filename, name))
+                if name + "/" not in self._groups:
+                    groups.append(keys + (k,))
+                self._collect_schema(D[k], keys + (k,), groups, entries)
+            elif name + "/" in self._groups:
+                log_and_raise_error(logger, "Cannot write dictionary to %s. The value of %s replaces a group of the same name." % (self._filename, name))
+            elif name not in self._shapes and name not in self._skipped:
+                try:
+                    data_shape, dtype, axes = _resolve_dtype_and_shape(D[k])
+                except TypeError:
+                    log_warning(logger, "Could not save dataset %s. Conversion to numpy array failed" % name)
+                    self._skipped.add(name)
+                    continue
+                entries.append((keys + (k,), data_shape, dtype, axes))
+
+    def _open(self, max_chunk_nbytes):
+        # The file space is managed in pages that hold metadata and small datasets together
+        page_size = _MIN_PAGE_BYTES
+        while page_size < 2*max_chunk_nbytes and page_size < _MAX_PAGE_BYTES:
+            page_size *= 2
+        if self._comm is None:
+            log_debug(logger, "Open file %s [page size: %i bytes]" % (self._filename, page_size))
+            self._f = h5py.File(self._filename, "w", libver="latest", fs_strategy="page", fs_page_size=page_size)
+        else:
+            log_debug(logger, "Open file %s with MPI driver [rank %i of %i]" % (self._filename, self._comm.rank, self._comm.size))
+            self._f = h5py.File(self._filename, "w", driver="mpio", comm=self._comm, libver="latest")
+        self._groups["/"] = self._f
+
+    def _get_chunks(self, data_shape, dtype):
+        if self._chunks == "auto":
+            return True
+        itemsize = numpy.dtype(dtype).itemsize
+        nbytes = int(numpy.prod(data_shape)) * itemsize
+        if nbytes >= _MIN_CHUNK_BYTES:
+            # One stack entry per chunk, optimal for reading single frames
+            chunks = [1] + list(data_shape)
+            # Oversized entries are split into slabs by halving the chunk along the leading axes of the entry
+            i = 1
+            while int(numpy.prod(chunks)) * itemsize > _MAX_CHUNK_BYTES:
+                while chunks[i] == 1:
+                    i += 1
+                chunks[i] = -(-chunks[i] // 2)
+            return tuple(chunks)
+        else:
+            # Small entries (e.g. scalars) are grouped together to avoid many tiny chunks
+            n = max(self._chunksize, -(-_MIN_CHUNK_BYTES // max(nbytes, 1)))
+            n = min(n, _MAX_CHUNK_BYTES // max(nbytes, 1))
+            # HDF5 requires positive chunk dimensions, also for entries of zero length
+            return (n,) + tuple([max(d, 1) for d in data_shape])
+
+    def _write_buffer(self):
+        if self._comm is None:
+            if self._buffered == 0:
+                return
+            start = self._n_written
+            stop = total = start + self._buffered
+        else:
+            # Every process writes its entries to a contiguous range of stack positions following those of the processes with lower rank
+            counts = self._comm.allgather(self._buffered)
+            start = self._n_written + sum(counts[:self._comm.rank])
+            stop = start + self._buffered
+            total = self._n_written + sum(counts)
+            if total == self._n_written:
+                return
+        try:
+            for name, (keys, buf, dset, index_buf, hashes) in self._deduplicated.items():
+                # Only entries whose hash has not been seen before are written, all others reference the first identical entry
+                n_unique = len(hashes)
+                new_hashes = {}
+                rows = []
+                for r in range(self._buffered):
+                    h = hashlib.blake2b(buf[r], digest_size=16).digest()
+                    if h not in hashes and h not in new_hashes:
+                        new_hashes[h] = n_unique + len(rows)
+                        rows.append(r)
+                    index_buf[r] = hashes[h] if h in hashes else new_hashes[h]
+                if rows:
+                    self._grow(name, dset, n_unique + len(rows))
+                    log_debug(logger, "Write %i unique entries to dataset %s" % (len(rows), dset.name))
+                    dset.write_direct(buf[rows], dest_sel=numpy.s_[n_unique:n_unique+len(rows)])
+                hashes.update(new_hashes)
+            for name, buf in self._buffer.items():
+                dset = self._datasets[name]
+                self._grow(name, dset, total)
+                log_debug(logger, "Write to dataset %s at stack positions %i-%i" % (name, start, stop-1))
+                if self._comm is None:
+                    dset.write_direct(buf, source_sel=numpy.s_[:self._buffered], dest_sel=numpy.s_[start:stop])
                 else:
-                    self._f[name][self._i,:] = data[:]
-
-    def _shrink_stacks(self, group_prefix="/"):
-        for k in self._f[group_prefix].keys():
-            name = group_prefix + k
-            if isinstance(self._f[name], h5py.Dataset):
-                log_debug(logger, "Shrinking dataset %s to stack length %i" % (name, self._i))
-                s = list(self._f[name].shape)
-                s.pop(0)
-                s.insert(0, self._i)
-                s = tuple(s)
-                self._f[name].resize(s)
-            else:
-                self._shrink_stacks(name + "/")
+                    with dset.collective:
+                        dset.write_direct(buf, source_sel=numpy.s_[:self._buffered], dest_sel=numpy.s_[start:stop])
+            self._n_written = total
+        finally:
+            # The entries of a batch that could not be written are discarded, the following entries take their stack positions
+            self._buffered = 0
+
+    def _grow(self, name, dset, n):
+        shape = self._shapes[name]
+        if shape[0] < n:
+            # Grow geometrically to keep the number of resizes logarithmic in the stack length
+            new_len = max(shape[0]*2, n)
+            new_len = -(-new_len // self._chunksize) * self._chunksize
+            new_shape = (new_len,) + shape[1:]
+            log_debug(logger, "Resize dataset %s [old shape: %s, new shape: %s]" % (name,str(shape),str(new_shape)))
+            dset.resize(new_shape)
+            self._shapes[name] = new_shape
+
+    def _create_virtual_datasets(self):
+        for name, (keys, buf, dset, index_buf, hashes) in self._deduplicated.items():
+            s = self._shapes[name]
+            index = self._datasets[name + "_index"][:]
+            layout = h5py.VirtualLayout(shape=(len(index),) + buf.shape[1:], dtype=dset.dtype)
+            source = h5py.VirtualSource(".", dset.name, shape=s, dtype=dset.dtype)
+            # One mapping for every run of stack positions that reference consecutive unique entries, a layout without entries has no mappings
+            starts = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(index) != 1) + 1, [len(index)]]).astype(int) if len(index) > 0 else []
+            for start, stop in zip(starts[:-1], starts[1:]):
+                layout[start:stop] = source[index[start]:index[start]+stop-start]
+            log_debug(logger, "Create virtual dataset %s [%i entries, %i unique]" % (name, len(index), s[0]))
+            vdset = self._groups[_get_group_prefix(keys[:-1])].create_virtual_dataset(keys[-1], layout)
+            vdset.attrs.modify("axes", dset.attrs["axes"])
+
+    def _shrink_stacks(self):
+        # Datasets are shrunk based on the cached stack shapes, datasets that have the right length already are not touched
+        stacks = [(name, dset, self._n_written) for name, dset in self._datasets.items()]
+        stacks += [(name, dset, len(hashes)) for name, (keys, buf, dset, index_buf, hashes) in self._deduplicated.items()]
+        for name, dset, n in stacks:
+            s = (n,) + self._shapes[name][1:]
+            if self._shapes[name] != s:
+                log_debug(logger, "Shrinking dataset %s to stack length %i" % (dset.name, n))
+                dset.resize(s)
+                self._shapes[name] = s
                     
+    def sync(self):
+        """
+        Write all buffered entries to file and flush the file. In MPI mode all processes must call this method
+        """
+        if self._f is None:
+            return
+        self._write_buffer()
+        self._f.flush()
+
     def close(self):
-        self._shrink_stacks()
-        log_debug(logger, "Closing file %s" % self._filename)
-        self._f.close()
+        """
+        Write all buffered entries, shrink the stacks to the number of written entries and close the file
+        """
+        if self._f is None:
+            self._open(0)
+        try:
+            self._write_buffer()
+            self._shrink_stacks()
+            self._create_virtual_datasets()
+        finally:
+            log_debug(logger, "Closing file %s" % self._filename)
+            self._f.close()
 
 
 def read_map(filename):
@@ -139,10 +561,12 @@ def read_map(filename):
     with open(filename, "rb") as f:
         # 1024 bytes header
         header_buf = f.read(1024)
+        header = numpy.frombuffer(header_buf, dtype="int32", count=256)
+        header_float32 = numpy.frombuffer(header_buf, dtype="float32", count=256)
         #1      NC              # of Columns    (fastest changing in map)
         #2      NR              # of Rows
         #3      NS              # of Sections   (slowest changing in map)
-        NCNRNS = tuple(numpy.frombuffer(header_buf, dtype="int32")[:3])
+        NCNRNS = (int(header[0]), int(header[1]), int(header[2]))
         #4      MODE            Data type
         #                  0 = envelope stored as signed bytes (from
         #                      -128 lowest to 127 highest)
@@ -155,16 +579,19 @@ def read_map(filename):
         #                  Note: Mode 2 is the normal mode used in
         #                        the CCP4 programs. Other modes than 2 and 0
         #                        may NOT WORK
-        MODE = numpy.frombuffer(header_buf, dtype="int32")[3]
-        dtype = ["i8", "int32", "float32", "cint32", "complex64", "i8"][MODE]
-        if dtype_mode not in [0,2]:
+        MODE = int(header[3])
+        dtype = ["int8", "int16", "float32", None, "complex64", "int8"][MODE]
+        if MODE == 3:
+            log_and_raise_error(logger, "Map file data type \"MODE=%i\" is not implemented yet." % MODE)
+        if MODE not in [0,2]:
             log_warning(logger, "WARNING: Map file data type \"MODE=%i\" may not work." % MODE)
+        #11      X length        Cell Dimensions (Angstroms)
+        dx = float(header_float32[10])/NCNRNS[0]*1E-10
         #24      NSYMBT          Number of bytes used for storing symmetry operators
-        NSYMBT = numpy.frombuffer(header_buf, dtype="int32")[23]
+        NSYMBT = int(header[23])
         if NSYMBT > 0:
             log_warning(logger, "WARNING: Omitting symmetry operations in map file.")
             f.read(NSYMBT)
         # The remaining bytes are data
-        data = f.read()
-        data = numpy.frombuffer(data, dtype=dtype).reshape(NCNRNS)
+        data = numpy.fromfile(f, dtype=dtype, count=NCNRNS[0]*NCNRNS[1]*NCNRNS[2]).reshape(NCNRNS)
     return data, dx
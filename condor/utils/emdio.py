@@ -125,8 +125,7 @@ def read_map(filename):
             log_and_raise_error(logger, "Omitting symmetry operations in map file.")
             f.read(NSYMBT)
         # The remaining bytes are data
-        raw_data = f.read()
-        raw_data = numpy.frombuffer(raw_data, dtype=dtype)
+        raw_data = numpy.fromfile(f, dtype=dtype, count=int(NC)*int(NR)*int(NS))
         # Now we need to project onto the right Z-Y-X array grid
         S,R,C = numpy.meshgrid(numpy.arange(NS), numpy.arange(NR), numpy.arange(NC), indexing='ij')
         S = S.flatten()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
-import os
+import os, sys, subprocess, multiprocessing
+from multiprocessing.pool import ThreadPool
 
 repodir = os.path.dirname(os.path.realpath(__file__))
 examplesdir_configfile = os.path.join(repodir, "examples", "configfile")
@@ -13,103 +14,120 @@ def run_examples(on_travis=False):
         {
             "name": "PARTICLE IDEAL SPHERE (configfile)",
             "dir": os.path.join(examplesdir_configfile, "particle_sphere"),
-            "cmd": "rm -f condor.cxi; condor",
+            "cmd": ["condor"],
+            "clean": True,
             "travis": True,
         },
         {
             "name": "PARTICLE IDEAL SPHEROID (configfile)",
             "dir": os.path.join(examplesdir_configfile, "particle_spheroid"),
-            "cmd": "rm -f condor.cxi; condor",
+            "cmd": ["condor"],
+            "clean": True,
             "travis": True,
         },
         {
             "name": "PARTICLE MAP (configfile)",
             "dir": os.path.join(examplesdir_configfile, "particle_map"),
-            "cmd": "rm -f condor.cxi; condor",
+            "cmd": ["condor"],
+            "clean": True,
             "travis": True,
         },
         {
             "name": "PARTICLE ATOMS (configfile)",
             "dir": os.path.join(examplesdir_configfile, "particle_atoms"),
-            "cmd": "rm -f condor.cxi; condor",
+            "cmd": ["condor"],
+            "clean": True,
             "travis": True,
         },
         {
             "name": "PARTICLE CUSTOM MAP (script)",
             "dir": os.path.join(examplesdir_scripts, "custom_map"),
-            "cmd": "rm -f condor.cxi; python example.py",
+            "cmd": [sys.executable, "example.py"],
+            "clean": True,
             "travis": False,
         },
         {
             "name": "PARTICLE MAP EMD FETCH (script)",
             "dir": os.path.join(examplesdir_scripts, "emd_fetch"),
-            "cmd": "rm -f condor.cxi; python example.py",
+            "cmd": [sys.executable, "example.py"],
+            "clean": True,
             "travis": False,
         },
         {
             "name": "PARTICLE MAP MODELS (script)",
             "dir": os.path.join(examplesdir_scripts, "particle_models"),
-            "cmd": "rm -f condor.cxi; python example.py",
+            "cmd": [sys.executable, "example.py"],
+            "clean": True,
             "travis": True,
         },
         {
             "name": "PARTICLE ROTATIONS (script)",
             "dir": os.path.join(examplesdir_scripts, "rotations"),
-            "cmd": "rm -f condor.cxi; python example.py",
+            "cmd": [sys.executable, "example.py"],
+            "clean": True,
             "travis": True,
         },
         {
             "name": "PARTICLE SIMPLE (script)",
             "dir": os.path.join(examplesdir_scripts, "simple"),
-            "cmd": "rm -f condor.cxi; python example.py",
+            "cmd": [sys.executable, "example.py"],
+            "clean": True,
             "travis": True,
         },
         {
             "name": "PARTICLE ATOMS PDB FETCH (script)",
             "dir": os.path.join(examplesdir_scripts, "pdb_fetch"),
-            "cmd": "rm -f condor.cxi; python example.py",
+            "cmd": [sys.executable, "example.py"],
+            "clean": True,
             "travis": True,
         },
         {
             "name": "PARTICLE ATOMS PDB FILE (script)",
             "dir": os.path.join(examplesdir_scripts, "pdb"),
-            "cmd": "rm -f condor.cxi; python example.py",
+            "cmd": [sys.executable, "example.py"],
+            "clean": True,
             "travis": True,
         },
         {
             "name": "PARTICLE MAP MULTIPLE MATERIALS (script)",
             "dir": os.path.join(examplesdir_scripts, "multiple_materials"),
-            "cmd": "python example.py",
+            "cmd": [sys.executable, "example.py"],
+            "clean": False,
             "travis": False,
         },
         {
             "name": "PARTICLE MAP DIFFRACTION SPACE 3D INTERPOLATION (script)",
             "dir": os.path.join(examplesdir_scripts, "diffraction_3d"),
-            "cmd": "python example.py",
+            "cmd": [sys.executable, "example.py"],
+            "clean": False,
             "travis": False,
         },
         {
             "name": "DIFFRACTION SPACE 3D SIMULATION (script)",
             "dir": os.path.join(examplesdir_scripts, "full_fourier_volume"),
-            "cmd": "python example.py",
+            "cmd": [sys.executable, "example.py"],
+            "clean": False,
             "travis": True,
         },
         {
             "name": "PUBLICATION EXAMPLE A: PARTICLE ATOMS GROEL (configfile)",
             "dir": os.path.join(examplesdir_publication, "a"),
-            "cmd": "rm -f condor.cxi; condor",
+            "cmd": ["condor"],
+            "clean": True,
             "travis": True,
         },
         {
             "name": "PUBLICATION EXAMPLE B: PARTICLE MAP EMD1144 (configfile)",
             "dir": os.path.join(examplesdir_publication, "b"),
-            "cmd": "rm -f condor.cxi; condor",
+            "cmd": ["condor"],
+            "clean": True,
             "travis": False,
         },
         {
             "name": "PUBLICATION EXAMPLE B: PARTICLE MAP EMD1144 (script)",
             "dir": os.path.join(examplesdir_scripts, "publication_example_b"),
-            "cmd": "rm -f condor.cxi; python example.py",
+            "cmd": [sys.executable, "example.py"],
+            "clean": True,
             "travis": False,
         },        
     ]
@@ -118,29 +136,49 @@ def run_examples(on_travis=False):
         examples = [e for e in examples if e["travis"]]
 
     nerrors = 0
-        
-    print("-"*100)
-    print("")
-    for i,e in enumerate(examples):
-        print(">>> Example %i/%i: %s" % (i+1, len(examples), e["name"]))
-        cmd = "cd %s; %s" % (e["dir"],e["cmd"])
-        print(cmd)
-        print("[start output]")
-        error = os.system(cmd)
-        print("[end output]")
-        if error != 0:
-            nerrors += 1
-            raise Exception(">>> Example %i (%s) failed. Abort." % (i+1,e["name"]))
-        else:
-            print(">>> Success!")
-        print("")
+
+    # Examples run in parallel, each in a subprocess of its own. The examples use multithreaded FFTs and much memory, therefore only a few run at the same time
+    n_workers = max(1, min(4, multiprocessing.cpu_count() // 2))
+    pool = ThreadPool(n_workers)
+    try:
+        results = [pool.apply_async(_run_example, (e,)) for e in examples]
+
         print("-"*100)
         print("")
+        for i,(e,r) in enumerate(zip(examples, results)):
+            returncode, output = r.get()
+            print(">>> Example %i/%i: %s" % (i+1, len(examples), e["name"]))
+            print("cd %s; %s" % (e["dir"], " ".join(e["cmd"])))
+            print("[start output]")
+            print(output)
+            print("[end output]")
+            if returncode != 0:
+                nerrors += 1
+                print(">>> Example %i (%s) failed." % (i+1,e["name"]))
+            else:
+                print(">>> Success!")
+            print("")
+            print("-"*100)
+            print("")
+    finally:
+        pool.close()
+        pool.join()
 
     if nerrors == 0:
         print("SUCCESS: All examples finished successfully.")
     else:
         print("ERROR: %i/%i example(s) failed." % (nerrors, len(examples)))
+        raise Exception("%i/%i example(s) failed." % (nerrors, len(examples)))
+
+
+def _run_example(e):
+    if e["clean"]:
+        filename = os.path.join(e["dir"], "condor.cxi")
+        if os.path.exists(filename):
+            os.remove(filename)
+    p = subprocess.Popen(e["cmd"], cwd=e["dir"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    output = p.communicate()[0]
+    return p.returncode, output
 
 
 if __name__ == "__main__":
@@ -0,0 +1,334 @@
+import unittest, os, tempfile, shutil
+import numpy, h5py
+from condor.utils import cxiwriter
+try:
+    import mpi4py
+except ImportError:
+    mpi4py = None
+
+class TestCaseCXIWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "test.cxi")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, N, **kwargs):
+        W = cxiwriter.CXIWriter(self.filename, **kwargs)
+        for i in range(N):
+            W.write({"entry_1": {"data_1": {"data": numpy.full((4,5), i, dtype="float32")},
+                                 "index": i,
+                                 "name": "frame%i" % i,
+                                 "pair": [i, i+1]}})
+        W.close()
+
+    def test_roundtrip(self):
+        for N, chunksize in [(1,2), (7,2), (7,3), (8,4), (10,1), (50,3), (33,5)]:
+            self._write(N, chunksize=chunksize)
+            with h5py.File(self.filename, "r") as f:
+                self.assertEqual(f["/entry_1/data_1/data"].shape, (N,4,5))
+                self.assertEqual(f["/entry_1/data_1/data"].dtype, numpy.float32)
+                self.assertTrue((f["/entry_1/data_1/data"][:,2,3] == numpy.arange(N)).all())
+                self.assertTrue((f["/entry_1/index"][:] == numpy.arange(N)).all())
+                self.assertEqual(f["/entry_1/name"].asstr()[-1], "frame%i" % (N-1))
+                self.assertEqual(f["/entry_1/pair"][N-1].tolist(), [N-1, N])
+                self.assertEqual(f["/entry_1/data_1/data"].attrs["axes"][0], "experiment_identifier:y:x")
+
+    def test_expected_n(self):
+        for N, expected_n in [(5,5), (7,3), (3,10)]:
+            self._write(N, chunksize=2, expected_n=expected_n)
+            with h5py.File(self.filename, "r") as f:
+                self.assertEqual(f["/entry_1/data_1/data"].shape, (N,4,5))
+                self.assertTrue((f["/entry_1/index"][:] == numpy.arange(N)).all())
+
+    def test_compression(self):
+        for compression in ["gzip", "lz4", "blosc", "bitshuffle"]:
+            if compression != "gzip" and cxiwriter.hdf5plugin is None:
+                continue
+            self._write(5, compression=compression)
+            with h5py.File(self.filename, "r") as f:
+                self.assertTrue((f["/entry_1/data_1/data"][:,2,3] == numpy.arange(5)).all())
+                self.assertIsNone(f["/entry_1/index"].compression)
+
+    def test_byteorder(self):
+        W = cxiwriter.CXIWriter(self.filename)
+        for i in range(3):
+            W.write({"data": numpy.arange(6, dtype=">f8").reshape((2,3))[:,::2]})
+        W.close()
+        with h5py.File(self.filename, "r") as f:
+            self.assertEqual(f["/data"].dtype, numpy.dtype("float64"))
+            self.assertEqual(f["/data"][2].tolist(), [[0., 2.], [3., 5.]])
+
+    def test_missing_key(self):
+        W = cxiwriter.CXIWriter(self.filename)
+        W.write({"entry_1": {"index": 0, "name": "a"}})
+        W.write({"entry_1": {"index": 1}})
+        W.write({"entry_1": {"index": 2, "name": "c"}})
+        W.write({"entry_2": {"index": 3}})
+        W.close()
+        with h5py.File(self.filename, "r") as f:
+            self.assertEqual(f["/entry_1/index"][:].tolist(), [0, 1, 2, 0])
+            self.assertEqual(f["/entry_1/name"].asstr()[:].tolist(), ["a", "", "c", ""])
+            self.assertEqual(f["/entry_2/index"][:].tolist(), [0, 0, 0, 3])
+
+    def test_skipped_key(self):
+        # Keys that cannot be converted to a dataset must not hide new keys
+        for template in [False, True]:
+            if template:
+                W = cxiwriter.CXIWriter.from_template(self.filename, {"x": None, "y": 0}, 2)
+            else:
+                W = cxiwriter.CXIWriter(self.filename)
+            W.write({"x": None, "y": 1})
+            W.write({"y": 2, "z": 5.0})
+            W.close()
+            with h5py.File(self.filename, "r") as f:
+                self.assertNotIn("x", f)
+                self.assertEqual(f["/y"][:].tolist(), [1, 2])
+                self.assertEqual(f["/z"][:].tolist(), [0., 5.])
+
+    def test_varying_particles(self):
+        # Number of particles varies from shot to shot with random particle arrival
+        for counts in [[3,1,2], [1,3,2,0,4]]:
+            W = cxiwriter.CXIWriter(self.filename, chunksize=2)
+            for i, n in enumerate(counts):
+                particles = dict([("particle_%02i" % p, {"position": numpy.full(3, i+1.), "diameter": float(p+1)}) for p in range(n)])
+                W.write({"entry_1": {"data_1": {"data": numpy.full((4,5), i, dtype="float32")}}, "particles": particles})
+            W.close()
+            with h5py.File(self.filename, "r") as f:
+                self.assertEqual(f["/entry_1/data_1/data"][:,0,0].tolist(), list(range(len(counts))))
+                self.assertEqual(len(f["/particles"].keys()), max(counts))
+                for p in range(max(counts)):
+                    self.assertEqual(f["/particles/particle_%02i/position" % p][:,0].tolist(), [i+1. if p < n else 0. for i, n in enumerate(counts)])
+                    self.assertEqual(f["/particles/particle_%02i/diameter" % p][:].tolist(), [p+1. if p < n else 0. for n in counts])
+
+    def test_replaced_group(self):
+        W = cxiwriter.CXIWriter(self.filename)
+        W.write({"a": {"x": 1}, "b": 2})
+        self.assertRaises(RuntimeError, W.write, {"a": 1, "b": 2})
+        W.close()
+
+    def test_empty(self):
+        W = cxiwriter.CXIWriter(self.filename)
+        W.close()
+        with h5py.File(self.filename, "r") as f:
+            self.assertEqual(len(f.keys()), 0)
+
+    def test_unwritable(self):
+        self.assertRaises(RuntimeError, cxiwriter.CXIWriter, os.path.join(self.tmpdir, "nonexistent", "test.cxi"))
+        # Files are created at construction
+        W = cxiwriter.CXIWriter(self.filename)
+        self.assertTrue(os.path.exists(self.filename))
+        W.close()
+
+    def test_sync(self):
+        W = cxiwriter.CXIWriter(self.filename, chunksize=4)
+        for i in range(3):
+            W.write({"index": i})
+        W.sync()
+        with h5py.File(self.filename, "r") as f:
+            self.assertEqual(f["/index"][:3].tolist(), [0, 1, 2])
+        for i in range(3, 6):
+            W.write({"index": i})
+        W.close()
+        with h5py.File(self.filename, "r") as f:
+            self.assertEqual(f["/index"][:].tolist(), list(range(6)))
+
+    def test_casting(self):
+        W = cxiwriter.CXIWriter(self.filename)
+        W.write({"index": 0, "value": 0.5, "data": numpy.zeros(3, dtype="float64")})
+        W.write({"index": numpy.int16(1), "value": 2, "data": [1, 2, 3]})
+        self.assertRaises(RuntimeError, W.write, {"index": 2.5, "value": 0.5, "data": numpy.zeros(3)})
+        with self.assertRaises(RuntimeError) as cm:
+            W.write({"index": 2, "value": 0.5, "data": numpy.zeros(4)})
+        self.assertIn("/data", str(cm.exception))
+        with self.assertRaises(RuntimeError) as cm:
+            W.write({"index": 2, "value": "b", "data": numpy.zeros(3)})
+        self.assertIn("/value", str(cm.exception))
+        W.close()
+        with h5py.File(self.filename, "r") as f:
+            self.assertEqual(f["/index"][:].tolist(), [0, 1])
+            self.assertEqual(f["/value"][:].tolist(), [0.5, 2.])
+            self.assertEqual(f["/data"][1].tolist(), [1., 2., 3.])
+
+    def test_shape(self):
+        W = cxiwriter.CXIWriter(self.filename)
+        W.write({"data": numpy.arange(5.)})
+        for value in [numpy.array([7.]), 3.0, numpy.zeros((1,5)), [1., 2.], [[1.], [1., 2.]]]:
+            with self.assertRaises(RuntimeError) as cm:
+                W.write({"data": value})
+            self.assertIn("/data", str(cm.exception))
+        W.write({"data": [1., 2., 3., 4., 5.]})
+        W.close()
+        with h5py.File(self.filename, "r") as f:
+            self.assertEqual(f["/data"][:].tolist(), [[0., 1., 2., 3., 4.], [1., 2., 3., 4., 5.]])
+
+    def test_string_type(self):
+        W = cxiwriter.CXIWriter(self.filename, chunksize=2)
+        W.write({"s": "a", "index": 0})
+        with self.assertRaises(RuntimeError) as cm:
+            W.write({"s": 5, "index": 1})
+        self.assertIn("/s", str(cm.exception))
+        for i in range(1, 4):
+            W.write({"s": "abc"[i-1], "index": i})
+        W.close()
+        with h5py.File(self.filename, "r") as f:
+            self.assertEqual(f["/s"].asstr()[:].tolist(), ["a", "a", "b", "c"])
+            self.assertEqual(f["/index"][:].tolist(), [0, 1, 2, 3])
+
+    def test_failed_batch(self):
+        # A batch that cannot be written is discarded and does not block later writes
+        W = cxiwriter.CXIWriter.from_template(self.filename, {"s": "", "index": 0}, 4, chunksize=2)
+        W.write({"s": "a", "index": 0})
+        self.assertRaises(TypeError, W.write, {"s": 5, "index": 1})
+        self.assertEqual(W._buffered, 0)
+        for i in range(2, 5):
+            W.write({"s": "x%i" % i, "index": i})
+        W.close()
+        with h5py.File(self.filename, "r") as f:
+            self.assertEqual(f["/s"].asstr()[:].tolist(), ["x2", "x3", "x4"])
+            self.assertEqual(f["/index"][:].tolist(), [2, 3, 4])
+
+    def test_scalar_types(self):
+        W = cxiwriter.CXIWriter(self.filename)
+        for i in range(3):
+            W.write({"str": u"\u00c5ngstr\u00f6m%i" % i, "bool": bool(i%2), "float32": numpy.float32(i), "uint8": numpy.uint8(i)})
+        W.close()
+        with h5py.File(self.filename, "r") as f:
+            self.assertEqual(f["/str"].asstr()[2], u"\u00c5ngstr\u00f6m2")
+            self.assertEqual(f["/bool"][:].tolist(), [False, True, False])
+            self.assertEqual(f["/float32"].dtype, numpy.float32)
+            self.assertEqual(f["/uint8"].dtype, numpy.uint8)
+            self.assertEqual(f["/uint8"].attrs["axes"][0], "experiment_identifier:value")
+
+    def test_dedup(self):
+        frames = [numpy.full((64,64), v, dtype="float32") for v in [0, 0, 1, 2, 0, 3, 1, 1]]
+        W = cxiwriter.CXIWriter(self.filename, chunksize=3, dedup=True)
+        for i, frame in enumerate(frames):
+            W.write({"entry_1": {"data_1": {"data": frame}, "index": i}})
+        W.close()
+        with h5py.File(self.filename, "r") as f:
+            self.assertTrue(f["/entry_1/data_1/data"].is_virtual)
+            self.assertEqual(f["/entry_1/data_1/data_unique"].shape, (4,64,64))
+            self.assertEqual(f["/entry_1/data_1/data_index"][:].tolist(), [0, 0, 1, 2, 0, 3, 1, 1])
+            self.assertEqual(f["/entry_1/data_1/data"].shape, (8,64,64))
+            self.assertEqual(f["/entry_1/data_1/data"][:,5,7].tolist(), [0, 0, 1, 2, 0, 3, 1, 1])
+            self.assertFalse(f["/entry_1/index"].is_virtual)
+
+    def test_dedup_empty(self):
+        W = cxiwriter.CXIWriter.from_template(self.filename, {"data": numpy.zeros((64,64), dtype="float32")}, 4, dedup=True)
+        W.close()
+        with h5py.File(self.filename, "r") as f:
+            self.assertTrue(f["/data"].is_virtual)
+            self.assertEqual(f["/data"].shape, (0,64,64))
+        # The file was closed and can be written again
+        self._write(2, dedup=True)
+
+    def test_dedup_reserved_names(self):
+        frame = numpy.zeros((64,64), dtype="float32")
+        for D in [{"d": frame, "d_index": 1}, {"d_unique": 1, "d": frame}, {"d": frame, "d_index": {"x": 1}}]:
+            W = cxiwriter.CXIWriter(self.filename, dedup=True)
+            self.assertRaises(RuntimeError, W.write, D)
+            W.close()
+        W = cxiwriter.CXIWriter(self.filename, dedup=True)
+        W.write({"d": frame})
+        self.assertRaises(RuntimeError, W.write, {"d": frame, "d_index": 1})
+        self.assertRaises(RuntimeError, W.write, {"d": frame, "d_unique": {"x": 1}})
+        W.close()
+
+    def test_from_template(self):
+        template = {"entry_1": {"data_1": {"data": numpy.zeros((4,5), dtype="float32")}, "index": 0, "name": "", "pair": [0, 0]}}
+        for N, n_expected in [(7,7), (7,3), (2,10)]:
+            W = cxiwriter.CXIWriter.from_template(self.filename, template, n_expected, chunksize=3)
+            for i in range(N):
+                W.write({"entry_1": {"data_1": {"data": numpy.full((4,5), i, dtype="float32")},
+                                     "index": i,
+                                     "name": "frame%i" % i,
+                                     "pair": [i, i+1]}})
+            # Dictionaries with a different layout fall back to the generic write
+            W.write({"entry_1": {"index": N, "extra": 1.5}})
+            W.write({"entry_1": {"data_1": {"data": numpy.full((4,5), N+1, dtype="float32")}, "index": N+1, "name": "", "pair": [0, 0]}})
+            W.close()
+            with h5py.File(self.filename, "r") as f:
+                self.assertEqual(f["/entry_1/data_1/data"].shape, (N+2,4,5))
+                self.assertTrue((f["/entry_1/data_1/data"][:N,2,3] == numpy.arange(N)).all())
+                self.assertEqual(f["/entry_1/data_1/data"][N:,2,3].tolist(), [0, N+1])
+                self.assertTrue((f["/entry_1/index"][:] == numpy.arange(N+2)).all())
+                self.assertEqual(f["/entry_1/name"].asstr()[N-1], "frame%i" % (N-1))
+                self.assertEqual(f["/entry_1/pair"][N-1].tolist(), [N-1, N])
+                self.assertEqual(f["/entry_1/extra"][:].tolist(), [0.]*N + [1.5, 0.])
+
+    def test_read_map(self):
+        for MODE, dtype in [(0, "int8"), (1, "int16"), (2, "float32")]:
+            header = numpy.zeros(256, dtype="int32")
+            header[:4] = [4, 4, 4, MODE]
+            header_float32 = header.view("float32")
+            header_float32[10:13] = 20.
+            data = numpy.arange(64, dtype=dtype).reshape((4,4,4))
+            with open(self.filename, "wb") as f:
+                f.write(header.tobytes())
+                f.write(data.tobytes())
+            map3d, dx = cxiwriter.read_map(self.filename)
+            self.assertEqual(map3d.dtype, numpy.dtype(dtype))
+            self.assertTrue((map3d == data).all())
+            self.assertAlmostEqual(dx, 5E-10)
+
+    def test_zero_length(self):
+        for chunks in ["per_frame", "auto"]:
+            W = cxiwriter.CXIWriter(self.filename, chunks=chunks)
+            for i in range(3):
+                W.write({"empty": numpy.zeros(0), "empty_2d": numpy.zeros((4,0), dtype="int32"), "index": i})
+            W.close()
+            with h5py.File(self.filename, "r") as f:
+                self.assertEqual(f["/empty"].shape, (3,0))
+                self.assertEqual(f["/empty_2d"].shape, (3,4,0))
+                self.assertEqual(f["/index"][:].tolist(), [0, 1, 2])
+
+    def test_large_chunks(self):
+        for chunksize, data_shape, dtype in [(2, (300,100,100), "float64"), (2, (3000,1000), "uint8"), (2*10**6, (), "float64")]:
+            W = cxiwriter.CXIWriter(self.filename, chunksize=chunksize)
+            for i in range(3):
+                W.write({"data": numpy.full(data_shape, i, dtype=dtype)})
+            W.close()
+            with h5py.File(self.filename, "r") as f:
+                chunks = f["/data"].chunks
+                self.assertLessEqual(int(numpy.prod(chunks)) * numpy.dtype(dtype).itemsize, cxiwriter._MAX_CHUNK_BYTES)
+                self.assertEqual(f["/data"].shape, (3,) + data_shape)
+                self.assertTrue((f["/data"][...].reshape((3,-1))[:,-1] == numpy.arange(3)).all())
+
+    def test_from_template_layout_change(self):
+        # Dictionaries with fewer keys take the generic copy without regenerating the write method
+        W = cxiwriter.CXIWriter.from_template(self.filename, {"a": 0, "b": 0}, 4)
+        write = W.write
+        W.write({"a": 1})
+        W.write({"a": 2, "b": 2})
+        self.assertIs(W.write, write)
+        W.write({"a": 3, "c": 3})
+        self.assertIsNot(W.write, write)
+        W.close()
+        with h5py.File(self.filename, "r") as f:
+            self.assertEqual(f["/b"][:].tolist(), [0, 2, 0])
+            self.assertEqual(f["/c"][:].tolist(), [0, 0, 3])
+
+    @unittest.skipUnless(mpi4py is not None and h5py.get_config().mpi, "MPI mode requires mpi4py and h5py built with MPI support")
+    def test_mpi(self):
+        # Runs with a single process under pytest, run with e.g. "mpirun -n 2 python -m pytest tests/test_cxiwriter.py -k mpi" to test several processes
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+        # All processes write to the file of the first process
+        filename = comm.bcast(self.filename, root=0)
+        for N, chunksize, expected_n in [(7, 3, None), (5, 2, 20), (0, 2, None)]:
+            W = cxiwriter.CXIWriter(filename, chunksize=chunksize, expected_n=expected_n, mpi=True)
+            for i in range(N):
+                index = comm.rank*N + i
+                W.write({"entry_1": {"data_1": {"data": numpy.full((4,5), index, dtype="float32")}, "index": index}})
+            W.close()
+            comm.Barrier()
+            with h5py.File(filename, "r") as f:
+                if N == 0:
+                    self.assertEqual(len(f.keys()), 0)
+                    continue
+                self.assertEqual(f["/entry_1/data_1/data"].shape, (comm.size*N,4,5))
+                self.assertEqual(sorted(f["/entry_1/index"][:].tolist()), list(range(comm.size*N)))
+                self.assertTrue((f["/entry_1/data_1/data"][:,2,3] == f["/entry_1/index"][:]).all())
+            comm.Barrier()